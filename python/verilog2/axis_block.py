@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from typing import Any, Dict, List
+import functools
+from itertools import chain
+from typing import Any, Dict, List, Tuple
 
 import numpy
 from gnuradio import gr
@@ -22,7 +24,25 @@ from gnuradio import gr
 from . import verilator
 
 
+@functools.lru_cache(maxsize=128)
+def _make_sig(vlens: Tuple[int, ...]) -> List:
+    """
+    Returns the stream signature for the given vector lengths. The
+    result is cached since flowgraphs often contain many blocks with
+    the same bus widths.
+    """
+    return [(numpy.int32, (n,)) for n in vlens]
+
+
 class axis_block(gr.basic_block):
+    """
+    A generic block that executes the verilated module in a flowgraph.
+    Each stream item is one AXIS beat packed into vlen int32 words, so
+    the lanes of a wide bus are interleaved in memory. This layout is
+    dictated by the GNU Radio vector item format and cannot be changed
+    to a lane-major one without breaking every connected block.
+    """
+
     def __init__(self,
                  sources: List[str],
                  params: Dict[str, Any]):
@@ -33,24 +53,45 @@ class axis_block(gr.basic_block):
         gr.basic_block.__init__(
             self,
             name=module.component,
-            in_sig=[(numpy.int32, (n,)) for n in self.instance.input_vlens],
-            out_sig=[(numpy.int32, (n,)) for n in self.instance.output_vlens],
+            in_sig=_make_sig(tuple(self.instance.input_vlens)),
+            out_sig=_make_sig(tuple(self.instance.output_vlens)),
         )
 
+        # bound methods are cached since general_work is called by the
+        # scheduler for every batch of items, and the consume/produce
+        # calls for all ports are committed in a single fused loop
+        self._instance_work = self.instance.work
+        self._commit = \
+            [(self.consume, i) for i in range(len(self.instance.input_vlens))] + \
+            [(self.produce, i) for i in range(len(self.instance.output_vlens))]
+
+        # forecast is queried very frequently, so the returned list is
+        # rebuilt only when the requested batch size changes
+        self._forecast = []
+        self._forecast_items = 0
+
     def forecast(self, noutput_items, ninputs):
         # print("forecast", noutput_items, ninputs)
-        return [1 for _ in range(ninputs)]
+        if noutput_items != self._forecast_items:
+            self._forecast = [noutput_items] * ninputs
+            self._forecast_items = noutput_items
+        return self._forecast
 
     def general_work(self, input_items, output_items):
-        consumed, produced = self.instance.work(input_items, output_items)
+        consumed, produced = self._instance_work(input_items, output_items)
 
-        for idx, num in enumerate(consumed):
-            self.consume(idx, num)
-        for idx, num in enumerate(produced):
-            self.produce(idx, num)
+        for (fun, idx), num in zip(self._commit, chain(consumed, produced)):
+            fun(idx, num)
 
+        # the AXIS handshake carries no end-of-stream signal, so the
+        # model can never report that it is done on its own; the
+        # scheduler stops the block when its upstreams are finished
         return gr.WORK_CALLED_PRODUCE
 
+    @property
+    def regs(self) -> 'verilator.Registers':
+        return self.instance.regs
+
     def read_register(self, name: str) -> int:
         return self.instance.read_register(name)
 
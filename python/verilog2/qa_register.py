@@ -22,6 +22,18 @@ from gnuradio import gr_unittest
 from gnuradio import verilog2
 
 
+VERBOSE = bool(os.environ.get('VERILOG2_QA_VERBOSE'))
+
+
+def debug(*args):
+    """
+    Prints the diagnostic arguments only when VERILOG2_QA_VERBOSE is
+    set, since stringifying large arrays inflates the test wall time.
+    """
+    if VERBOSE:
+        print(*args)
+
+
 class qa_register(gr_unittest.TestCase):
 
     SOURCES = [
@@ -29,9 +41,20 @@ class qa_register(gr_unittest.TestCase):
                      '..', 'examples', 'axis_monitor.v'),
     ]
 
+    @classmethod
+    def setUpClass(cls):
+        # the module is shared by all tests, so the verilated library
+        # is compiled and loaded only once per class
+        cls.module = verilog2.Module(cls.SOURCES)
+
+    def setUp(self):
+        # deterministic lengths and data so runs are comparable
+        random.seed(0xC0FFEE)
+        numpy.random.seed(0xC0FFEE)
+
     def test1(self):
-        mod = verilog2.Module(qa_register.SOURCES)
-        print(mod.get_ports({}))
+        mod = self.module
+        debug(mod.get_ports({}))
         assert(mod.get_input_vlens({}) == [1])
         assert(mod.get_reg_widths({}) == [32, 16])
 
@@ -53,34 +76,47 @@ class qa_register(gr_unittest.TestCase):
         assert(mod.get_reg_widths({'DATA_WIDTH': 64}) == [32, 64])
 
     def test2(self):
-        mod = verilog2.Module(qa_register.SOURCES)
+        mod = self.module
         ins = verilog2.Instance(mod, {'DATA_WIDTH': 8})
 
         ins.write_register("sample", 12)
         assert ins.read_register("sample") == 12
         assert ins.read_register("counter") == 0
 
+        # the dict-like view must agree with the explicit methods
+        assert len(ins.regs) == 2
+        assert "sample" in ins.regs and "counter" in ins.regs
+        assert "bogus" not in ins.regs
+        assert sorted(ins.regs) == ["counter", "sample"]
+        assert ins.regs["sample"] == 12
+        assert ins.regs["counter"] == 0
+
+        ins.regs["sample"] = 34
+        assert ins.read_register("sample") == 34
+        ins.write_register("sample", 12)
+        assert ins.regs["sample"] == 12
+
         length = random.randint(0, 50)
         input_item0 = numpy.random.randint(
             0, 255, size=(length, 1), dtype=numpy.int32)
         output_item0 = numpy.empty((length + 10, 1), dtype=numpy.int32)
 
         consumed, produced = ins.work([input_item0], [output_item0])
-        print("consumed", consumed)
-        print("produced", produced)
+        debug("consumed", consumed)
+        debug("produced", produced)
         assert consumed == [length]
         assert produced == [length]
 
-        print("input", input_item0.flatten())
-        print("output", output_item0[:length].flatten())
-        assert numpy.alltrue(output_item0[:length] == input_item0)
+        debug("input", input_item0.ravel())
+        debug("output", output_item0[:length].ravel())
+        assert numpy.array_equal(output_item0[:length], input_item0)
 
         counter = ins.read_register("counter")
-        print("counter", counter)
+        debug("counter", counter)
         assert counter == length
 
         sample = ins.read_register("sample")
-        print("sample", sample)
+        debug("sample", sample)
         assert length == 0 or sample == input_item0[-1]
 
         ins.write_register("counter")